@@ -3,10 +3,42 @@ import numpy as np
 import matplotlib.pyplot as plt
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
+import io
+import json
 import os
 import re
+import sys
+import tempfile
+import threading
+import uuid
+import weakref
+import zipfile
+from collections import OrderedDict
 from datetime import datetime
 
+NUMBA_THREADING_LAYER_READY = False
+try:
+    import numba
+    from numba import prange
+except ImportError:  # Numba 為可選依賴，未安裝時使用 NumPy 向量化核心
+    numba = None
+    prange = range
+else:
+    # 多個工作階段會同時從 Streamlit 的執行緒呼叫 Numba 核心，需要執行緒安全的平行層；workqueue 並非執行緒安全，
+    # TBB 在非主執行緒使用後會使行程無法正常結束，因此只採用 OpenMP。無法載入 OpenMP 時改用 NumPy 核心。
+    # 部署環境已自行設定 NUMBA_THREADING_LAYER 時則尊重其設定。
+    if 'NUMBA_THREADING_LAYER' in os.environ:
+        NUMBA_THREADING_LAYER_READY = True
+    else:
+        try:
+            from numba.np.ufunc import omppool  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            os.environ['NUMBA_THREADING_LAYER'] = 'omp'
+            numba.config.reload_config()  # 自磁碟快取載入的核心不會重新編譯，需立即套用設定
+            NUMBA_THREADING_LAYER_READY = True
+
 # --- 基礎設定：中文字體與數字格式化 ---
 
 # 1. 字體設定 (*** REVISED LOGIC FOR CLOUD DEPLOYMENT ***)
@@ -62,107 +94,706 @@ def calculate_pmt(loan_amount, monthly_rate, num_payments):
         return loan_amount / num_payments
     return 0
 
-def simulate_down_payment(params):
-    """第一階段：頭期款準備期模擬"""
-    all_trajectories = []
-    months_limit = params['prep_years_limit'] * 12
-    target_down_payment = params['target_house_price'] * params['down_payment_ratio']
-    monthly_return_mean = (1 + params['annual_return_mean']) ** (1/12) - 1
-    monthly_return_std = params['annual_return_std'] / np.sqrt(12)
-    
-    success_count = 0
-    total_months_to_goal = []
+def loan_balance_schedule(loan_amount, monthly_rate, pmt, num_payments):
+    """逐月剩餘房貸本金 (長度為期數 + 1，首項為貸款總額)；各路徑共用，只需計算一次"""
+    balances = np.empty(num_payments + 1)
+    balances[0] = remaining_loan = loan_amount
+    for month in range(1, num_payments + 1):
+        interest_paid = remaining_loan * monthly_rate
+        remaining_loan -= pmt - interest_paid
+        balances[month] = remaining_loan
+    return balances
+
+# --- 市場報酬模型 ---
+# 每個模型以相同介面 (路徑數, 月數, rng) 一次產生 (路徑數 × 月數) 的標準化衝擊 (平均數 0、標準差 1)，
+# 再依年化平均報酬率與波動率線性縮放為月報酬率；同一組衝擊可套用不同的市場假設
+
+STUDENT_T_DF = 5                      # 肥尾分配的自由度，越小尾部越厚
+REGIME_ENTER_BEAR_PROB = 0.02         # 每月由多頭轉入空頭的機率
+REGIME_EXIT_BEAR_PROB = 0.10          # 每月由空頭回到多頭的機率
+REGIME_MEAN_GAP = 0.65                # 多空兩狀態的月平均報酬差距 (以月標準差為單位)
+REGIME_BEAR_VOL_MULTIPLIER = 2.0      # 空頭狀態的波動率倍數
+BOOTSTRAP_BLOCK_MONTHS = 12           # 區塊拔靴法每次抽取的連續月數
+HISTORICAL_RETURNS_CSV = os.environ.get('HOUSING_HISTORICAL_RETURNS_CSV', 'historical_returns.csv')
+
+def monthly_return_moments(annual_mean, annual_std):
+    """將年化平均報酬率與波動率換算為月報酬率的平均數與標準差"""
+    return (1 + annual_mean) ** (1/12) - 1, annual_std / np.sqrt(12)
+
+def calibrate_returns(shocks, annual_mean, annual_std):
+    """將標準化衝擊縮放為月報酬率 (float64 的新陣列，不修改傳入的衝擊)"""
+    monthly_mean, monthly_std = monthly_return_moments(annual_mean, annual_std)
+    returns = np.multiply(shocks, monthly_std, dtype=np.float64)
+    returns += monthly_mean
+    return returns
+
+def generate_normal_shocks(n_paths, n_months, rng):
+    """常態分配：各月報酬獨立且服從常態分配"""
+    return rng.standard_normal((n_paths, n_months))
+
+def generate_student_t_shocks(n_paths, n_months, rng):
+    """肥尾 Student-t 分配：標準化後與常態模型具有相同的平均數與標準差，但極端報酬更常出現"""
+    return np.sqrt((STUDENT_T_DF - 2) / STUDENT_T_DF) * rng.standard_t(STUDENT_T_DF, size=(n_paths, n_months))
+
+def generate_regime_switching_shocks(n_paths, n_months, rng):
+    """多空狀態轉換：以馬可夫鏈在多頭與高波動空頭之間切換，長期平均數與標準差與輸入一致"""
+    bear_share = REGIME_ENTER_BEAR_PROB / (REGIME_ENTER_BEAR_PROB + REGIME_EXIT_BEAR_PROB)
+    bull_mean = bear_share * REGIME_MEAN_GAP
+    bear_mean = -(1 - bear_share) * REGIME_MEAN_GAP
+    # 扣除兩狀態平均數差異貢獻的變異後，分配給狀態內的波動
+    within_var = max(1 - bear_share * (1 - bear_share) * REGIME_MEAN_GAP ** 2, 1e-12)
+    bull_std = np.sqrt(within_var / ((1 - bear_share) + bear_share * REGIME_BEAR_VOL_MULTIPLIER ** 2))
+
+    switch_draws = rng.random((n_paths, n_months))
+    is_bear = np.empty((n_paths, n_months), dtype=bool)
+    state = rng.random(n_paths) < bear_share
+    for month in range(n_months):
+        state = np.where(state, switch_draws[:, month] >= REGIME_EXIT_BEAR_PROB, switch_draws[:, month] < REGIME_ENTER_BEAR_PROB)
+        is_bear[:, month] = state
+    shocks = rng.standard_normal((n_paths, n_months))
+    return np.where(is_bear, bear_mean + bull_std * REGIME_BEAR_VOL_MULTIPLIER * shocks, bull_mean + bull_std * shocks)
+
+@st.cache_data(show_spinner=False)
+def load_historical_returns(path, modified_time):
+    """讀取歷史月報酬率 CSV (每列一個月，最後一欄為小數形式的月報酬率，可含標題列與日期欄)"""
+    data = np.genfromtxt(path, delimiter=',', ndmin=2)
+    returns = data[:, -1]
+    return returns[~np.isnan(returns)]
+
+def historical_returns_available():
+    return os.path.exists(HISTORICAL_RETURNS_CSV)
+
+def generate_bootstrap_shocks(n_paths, n_months, rng):
+    """區塊拔靴法：自歷史月報酬率中抽取連續區塊，保留肥尾與短期自我相關。
+
+    歷史序列會先標準化，再依輸入的平均報酬率與波動率重新縮放，使市場假設滑桿仍然有效。
+    """
+    history = load_historical_returns(HISTORICAL_RETURNS_CSV, os.path.getmtime(HISTORICAL_RETURNS_CSV))
+    if history.size < BOOTSTRAP_BLOCK_MONTHS * 2:
+        raise ValueError(f"歷史報酬率資料過少 ({history.size} 個月)，至少需要 {BOOTSTRAP_BLOCK_MONTHS * 2} 個月。")
+    standardized = (history - history.mean()) / history.std()
+
+    n_blocks = -(-n_months // BOOTSTRAP_BLOCK_MONTHS)
+    starts = rng.integers(0, history.size - BOOTSTRAP_BLOCK_MONTHS + 1, size=(n_paths, n_blocks))
+    indices = (starts[:, :, None] + np.arange(BOOTSTRAP_BLOCK_MONTHS)).reshape(n_paths, -1)[:, :n_months]
+    return standardized[indices]
+
+RETURN_MODELS = {
+    'normal': {'label': '常態分配', 'generator': generate_normal_shocks},
+    'student_t': {'label': '肥尾分配 (Student-t)', 'generator': generate_student_t_shocks},
+    'regime_switching': {'label': '多空狀態轉換', 'generator': generate_regime_switching_shocks},
+    'bootstrap': {'label': '歷史區塊拔靴法', 'generator': generate_bootstrap_shocks},
+}
+
+# 側邊欄可選的期限範圍，亦決定快取衝擊矩陣的長度
+MAX_PREP_YEARS = 20
+MORTGAGE_YEAR_OPTIONS = [20, 30, 40]
+# 衝擊矩陣一律以可選的最長準備期加最長房貸期產生，不同期限直接取前段，以便跨次執行重用
+RETURN_TENSOR_MONTHS = (MAX_PREP_YEARS + max(MORTGAGE_YEAR_OPTIONS)) * 12
+# 各組市場假設對應的參數名稱前綴
+RETURN_CALIBRATIONS = {'accumulation': 'annual_return', 'mortgage': 'post_purchase_return'}
+
+def available_return_models():
+    """目前可選用的市場報酬模型 (歷史資料檔存在時才提供拔靴法)"""
+    return [key for key in RETURN_MODELS if key != 'bootstrap' or historical_returns_available()]
+
+def return_source_version(model):
+    """報酬模型所依賴外部資料的版本 (歷史資料檔的修改時間)，資料更新後快取隨之失效"""
+    return os.path.getmtime(HISTORICAL_RETURNS_CSV) if model == 'bootstrap' else None
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def build_cached_shock_tensor(model, n_paths, seed, source_version):
+    """產生並快取完整期限的標準化衝擊矩陣 (float32)；與市場假設無關，僅模型、模擬次數、種子或資料改變時才重新產生"""
+    rng = np.random.default_rng(seed)
+    tensor = RETURN_MODELS[model]['generator'](n_paths, RETURN_TENSOR_MONTHS, rng).astype(np.float32)
+    tensor.setflags(write=False)  # 跨工作階段共用，禁止就地修改
+    register_shock_tensor(tensor)
+    return tensor
+
+def get_return_tensor(params, n_months, calibration):
+    """取得前 n_months 個月的月報酬率矩陣。
+
+    calibration 指定採用哪一組市場假設 ('accumulation' 或 'mortgage')；不同假設共用相同的標準化衝擊，
+    代表同一個市場情境。參數中有 random_seed 時使用快取的衝擊矩陣，僅在讀取時依市場假設縮放，
+    因此調整報酬率、波動率或收入、房價等參數時都可直接重用；否則每次重新產生。
+    """
+    if n_months > RETURN_TENSOR_MONTHS:
+        raise ValueError(f"模擬期間 {n_months} 個月超過上限 {RETURN_TENSOR_MONTHS} 個月 (準備期最長 {MAX_PREP_YEARS} 年、房貸最長 {max(MORTGAGE_YEAR_OPTIONS)} 年)")
+    prefix = RETURN_CALIBRATIONS[calibration]
+    model = params.get('market_model', 'normal')
+    if params.get('random_seed') is None:
+        shocks = RETURN_MODELS[model]['generator'](params['simulations'], n_months, np.random.default_rng())
+    else:
+        shocks = build_cached_shock_tensor(model, params['simulations'], params['random_seed'], return_source_version(model))[:, :n_months]
+    return calibrate_returns(shocks, params[f'{prefix}_mean'], params[f'{prefix}_std'])
+
+# --- 逐路徑月遞迴核心 (NumPy 向量化版本與可選的 Numba JIT 版本) ---
+
+def mortgage_kernel_numpy(returns, disposable_income, house_value, balances, net_worths, final_assets, depleted):
+    """第二階段核心 (NumPy)：逐月推進所有路徑，金融資產耗盡的路徑淨資產凍結不變"""
+    assets = np.zeros(returns.shape[0])
+    active = np.ones(returns.shape[0], dtype=bool)
+    net_worths[:, 0] = house_value - balances[0]
+    for month in range(1, returns.shape[1] + 1):
+        assets = np.where(active, (assets + disposable_income) * (1 + returns[:, month - 1]), assets)
+        current_net_worth = assets + house_value - max(0, balances[month])
+        net_worths[:, month] = np.where(active, current_net_worth, net_worths[:, month - 1])
+        active &= assets >= 0
+    final_assets[:] = assets
+    depleted[:] = ~active
+
+def mortgage_kernel_loop(returns, disposable_income, house_value, balances, net_worths, final_assets, depleted):
+    """第二階段核心 (逐路徑迴圈版本，供 Numba 編譯後多執行緒平行處理各路徑)"""
+    for i in prange(returns.shape[0]):
+        assets = 0.0
+        net_worths[i, 0] = house_value - balances[0]
+        is_depleted = False
+        for month in range(1, returns.shape[1] + 1):
+            if is_depleted:
+                net_worths[i, month] = net_worths[i, month - 1]
+                continue
+            assets = (assets + disposable_income) * (1 + returns[i, month - 1])
+            net_worths[i, month] = assets + house_value - max(0.0, balances[month])
+            if assets < 0:
+                is_depleted = True
+        final_assets[i] = assets
+        depleted[i] = is_depleted
+
+def lifetime_kernel_numpy(acc_returns, post_returns, initial_savings, monthly_savings, down_payment, prep_months,
+                          disposable_income, disposable_after_payoff, house_value, balances,
+                          net_worths, purchase_months, depleted_months):
+    """全程核心 (NumPy)：同一條時間軸上依序模擬儲蓄、於各路徑首次達標月份購屋、房貸期與清償後期間。
+
+    購屋時超過頭期款的儲蓄轉為金融資產；未在準備期內達標的路徑持續儲蓄、不購屋；
+    金融資產耗盡的路徑淨資產凍結不變，並記錄購屋後第幾個月耗盡。
+    """
+    n_paths, n_months = acc_returns.shape
+    num_payments = balances.shape[0] - 1
+    balances_ext = np.append(balances, 0.0)  # 清償後剩餘本金為 0
+    savings = np.full(n_paths, float(initial_savings))
+    assets = np.zeros(n_paths)
+    net_worths[:, 0] = savings
+    for month in range(1, n_months + 1):
+        saving = purchase_months == 0
+        savings = np.where(saving, (savings + monthly_savings) * (1 + acc_returns[:, month - 1]), savings)
+        buying = saving & (month <= prep_months) & (savings >= down_payment)
+        purchase_months[buying] = month
+        assets = np.where(buying, savings - down_payment, assets)
+
+        owning = ~saving & (depleted_months == 0)
+        months_owned = month - purchase_months
+        income = np.where(months_owned <= num_payments, disposable_income, disposable_after_payoff)
+        assets = np.where(owning, (assets + income) * (1 + post_returns[:, month - 1]), assets)
+        balance = balances_ext[np.clip(months_owned, 0, num_payments + 1)]
+        owner_net_worth = assets + house_value - np.maximum(0, balance)
+
+        net_worths[:, month] = np.where(saving, savings, np.where(owning, owner_net_worth, net_worths[:, month - 1]))
+        newly_depleted = owning & (assets < 0)
+        depleted_months[newly_depleted] = months_owned[newly_depleted]
+
+def lifetime_kernel_loop(acc_returns, post_returns, initial_savings, monthly_savings, down_payment, prep_months,
+                         disposable_income, disposable_after_payoff, house_value, balances,
+                         net_worths, purchase_months, depleted_months):
+    """全程核心 (逐路徑迴圈版本，供 Numba 編譯後多執行緒平行處理各路徑)"""
+    num_payments = balances.shape[0] - 1
+    for i in prange(acc_returns.shape[0]):
+        savings = initial_savings * 1.0
+        assets = 0.0
+        net_worths[i, 0] = savings
+        for month in range(1, acc_returns.shape[1] + 1):
+            if purchase_months[i] == 0:
+                savings = (savings + monthly_savings) * (1 + acc_returns[i, month - 1])
+                net_worths[i, month] = savings
+                if month <= prep_months and savings >= down_payment:
+                    purchase_months[i] = month
+                    assets = savings - down_payment
+                continue
+            if depleted_months[i] > 0:
+                net_worths[i, month] = net_worths[i, month - 1]
+                continue
+            months_owned = month - purchase_months[i]
+            if months_owned <= num_payments:
+                assets = (assets + disposable_income) * (1 + post_returns[i, month - 1])
+                balance = balances[months_owned]
+            else:
+                assets = (assets + disposable_after_payoff) * (1 + post_returns[i, month - 1])
+                balance = 0.0
+            net_worths[i, month] = assets + house_value - max(0.0, balance)
+            if assets < 0:
+                depleted_months[i] = months_owned
+
+def run_mortgage(kernels, returns, disposable_income, house_value, balances):
+    net_worths = np.empty((returns.shape[0], returns.shape[1] + 1))
+    final_assets = np.empty(returns.shape[0])
+    depleted = np.zeros(returns.shape[0], dtype=np.bool_)
+    kernels['mortgage'](returns, float(disposable_income), float(house_value), balances, net_worths, final_assets, depleted)
+    return net_worths, final_assets, depleted
+
+def run_lifetime(kernels, acc_returns, post_returns, initial_savings, monthly_savings, down_payment, prep_months,
+                 disposable_income, disposable_after_payoff, house_value, balances):
+    net_worths = np.empty((acc_returns.shape[0], acc_returns.shape[1] + 1))
+    purchase_months = np.zeros(acc_returns.shape[0], dtype=np.int64)
+    depleted_months = np.zeros(acc_returns.shape[0], dtype=np.int64)
+    kernels['lifetime'](acc_returns, post_returns, float(initial_savings), float(monthly_savings), float(down_payment), int(prep_months),
+                        float(disposable_income), float(disposable_after_payoff), float(house_value), balances,
+                        net_worths, purchase_months, depleted_months)
+    return net_worths, purchase_months, depleted_months
+
+# 模擬核心選擇：auto (預設，Numba 可用時採用) 或 numpy
+SIMULATION_ENGINE = os.environ.get('HOUSING_SIMULATION_ENGINE', 'auto')
+NUMPY_KERNELS = {
+    'name': 'numpy', 'mortgage': mortgage_kernel_numpy, 'lifetime': lifetime_kernel_numpy
+}
+
+def verify_kernel_equivalence(kernels, seed=20240601, n_paths=256):
+    """以固定種子比對編譯核心與 NumPy 核心的輸出是否一致"""
+    rng = np.random.default_rng(seed)
+    returns = calibrate_returns(generate_normal_shocks(n_paths, 360, rng), 0.06, 0.14)
+    balances = loan_balance_schedule(12000000, 0.022 / 12, calculate_pmt(12000000, 0.022 / 12, 360), 360)
+    for disposable_income in (15000, 500):  # 後者使部分路徑耗盡，以涵蓋凍結邏輯
+        expected = run_mortgage(NUMPY_KERNELS, returns, disposable_income, 15000000, balances)
+        actual = run_mortgage(kernels, returns, disposable_income, 15000000, balances)
+        if not all(np.allclose(e, a) for e, a in zip(expected, actual)):
+            return False
+    acc_returns = calibrate_returns(generate_normal_shocks(n_paths, 480, rng), 0.08, 0.16)
+    post_returns = calibrate_returns(generate_normal_shocks(n_paths, 480, rng), 0.06, 0.14)
+    for disposable_income, disposable_after_payoff in ((15000, 60000), (500, 45000)):
+        args = (acc_returns, post_returns, 800000, 30000, 3000000, 120, disposable_income, disposable_after_payoff, 15000000, balances)
+        expected = run_lifetime(NUMPY_KERNELS, *args)
+        actual = run_lifetime(kernels, *args)
+        if not all(np.allclose(e, a) for e, a in zip(expected, actual)):
+            return False
+    return True
+
+@st.cache_resource
+def get_simulation_kernels():
+    """選擇模擬核心：可用時採用 Numba JIT 多執行緒核心，否則退回 NumPy 向量化核心。
+
+    可透過環境變數 HOUSING_SIMULATION_ENGINE=numpy 強制使用 NumPy 核心；無法載入 OpenMP 平行層時亦使用 NumPy 核心。
+    快取於整個行程，避免 Streamlit 每次重新執行腳本時重新編譯；編譯結果另存於磁碟快取，新行程啟動時可直接載入。
+    """
+    if numba is None or SIMULATION_ENGINE == 'numpy':
+        return NUMPY_KERNELS
+    if not NUMBA_THREADING_LAYER_READY:
+        print("WARNING: Numba OpenMP threading layer unavailable, using NumPy kernels.")
+        return NUMPY_KERNELS
+    try:
+        kernels = {
+            'name': 'numba',
+            'mortgage': numba.njit(parallel=True, cache=True)(mortgage_kernel_loop),
+            'lifetime': numba.njit(parallel=True, cache=True)(lifetime_kernel_loop),
+        }
+        is_equivalent = verify_kernel_equivalence(kernels)  # 同時完成首次編譯
+    except Exception as e:
+        print(f"WARNING: Numba kernel compilation failed ({e}), falling back to NumPy.")
+        return NUMPY_KERNELS
+    if not is_equivalent:
+        print("WARNING: Numba kernels disagree with the NumPy engine, falling back to NumPy.")
+        return NUMPY_KERNELS
+    print(f"Numba JIT kernels enabled ({numba.config.NUMBA_NUM_THREADS} threads).")
+    return kernels
 
-    for _ in range(params['simulations']):
-        current_savings = params['initial_savings']
-        trajectory = [current_savings]
-        
-        for month in range(1, months_limit + 1):
-            current_savings += params['monthly_savings']
-            monthly_return = np.random.normal(monthly_return_mean, monthly_return_std)
-            current_savings *= (1 + monthly_return)
-            trajectory.append(current_savings)
-            
-            if current_savings >= target_down_payment:
-                success_count += 1
-                total_months_to_goal.append(month)
-                break
-        
-        all_trajectories.append(trajectory)
+def simulate_mortgage_period(params):
+    """第二階段：假設今天即以頭期款購屋、購屋後無其他金融資產的房貸與持有期模擬。
 
-    success_rate = success_count / params['simulations']
-    average_years_to_goal = (np.mean(total_months_to_goal) / 12) if total_months_to_goal else None
+    僅在全程整合模擬中沒有任何路徑購屋時使用，結果標示為假設情境 (purchased_share 為 0)。
+    """
+    house_price = params['target_house_price']
+    down_payment_amount = house_price * params['down_payment_ratio']
+    loan_amount = house_price - down_payment_amount
     
+    monthly_mortgage_rate = params['mortgage_rate'] / 12
+    num_mortgage_payments = params['mortgage_years'] * 12
+    pmt = calculate_pmt(loan_amount, monthly_mortgage_rate, num_mortgage_payments)
+    balances = loan_balance_schedule(loan_amount, monthly_mortgage_rate, pmt, num_mortgage_payments)
+
+    monthly_holding_cost = (house_price * params['annual_holding_cost_ratio']) / 12
+    disposable_income = params['monthly_income'] - params['monthly_expenses'] - pmt - monthly_holding_cost
+    returns = get_return_tensor(params, num_mortgage_payments, 'mortgage')
+
+    kernels = get_simulation_kernels()
+    all_net_worth_trajectories, financial_assets, depleted = run_mortgage(kernels, returns, disposable_income, house_price, balances)
+
     return {
-        "success_rate": success_rate,
-        "average_years": average_years_to_goal,
-        "all_trajectories": all_trajectories,
-        "target_down_payment": target_down_payment
+        "monthly_mortgage_payment": pmt,
+        "monthly_holding_cost": monthly_holding_cost,
+        "asset_depletion_risk": depleted.sum() / params['simulations'],
+        "all_net_worth_trajectories": all_net_worth_trajectories,
+        "final_net_worths": all_net_worth_trajectories[~depleted, -1],
+        "final_financial_assets": financial_assets[~depleted],
+        "loan_amount": loan_amount,
+        "engine": kernels['name']
     }
 
-def simulate_mortgage_period(params):
-    """第二階段：房貸與持有期模擬 (強化版)"""
+def lifetime_report_ages(current_age, total_months):
+    """跨階段統計的觀察年齡：每逢整十歲，以及模擬時間軸的終點"""
+    end_age = current_age + total_months // 12
+    return list(range((current_age // 10 + 1) * 10, end_age, 10)) + [end_age]
+
+def simulate_lifetime(params):
+    """全程整合模擬：每條路徑在同一條時間軸上依序經歷儲蓄、購屋與房貸期，一次產出兩階段結果與跨階段統計。
+
+    各路徑於首次達到頭期款的月份購屋，超出頭期款的儲蓄延續為金融資產；房貸清償後持續以結餘投資。
+    第二階段結果僅涵蓋在準備期內購屋的路徑，並自各自的購屋月份起算；
+    若沒有任何路徑購屋，則改以「今天購屋」的假設情境模擬第二階段，並以 purchased_share 為 0 標示。
+    """
     house_price = params['target_house_price']
     down_payment_amount = house_price * params['down_payment_ratio']
     loan_amount = house_price - down_payment_amount
-    
+
     monthly_mortgage_rate = params['mortgage_rate'] / 12
     num_mortgage_payments = params['mortgage_years'] * 12
     pmt = calculate_pmt(loan_amount, monthly_mortgage_rate, num_mortgage_payments)
+    balances = loan_balance_schedule(loan_amount, monthly_mortgage_rate, pmt, num_mortgage_payments)
 
     monthly_holding_cost = (house_price * params['annual_holding_cost_ratio']) / 12
-    
-    monthly_investment_return_mean = (1 + params['post_purchase_return_mean']) ** (1/12) - 1
-    monthly_investment_return_std = params['post_purchase_return_std'] / np.sqrt(12)
-    
-    all_net_worth_trajectories = []
-    asset_depletion_count = 0
-    final_net_worths = []
-    final_financial_assets = []
-
-    for _ in range(params['simulations']):
-        financial_assets = 0 
-        current_house_value = house_price
-        remaining_loan = loan_amount
-        net_worth_trajectory = [current_house_value - remaining_loan]
-        is_depleted = False
-
-        for month in range(1, num_mortgage_payments + 1):
-            if is_depleted:
-                net_worth_trajectory.append(net_worth_trajectory[-1])
-                continue
+    disposable_after_payoff = params['monthly_income'] - params['monthly_expenses'] - monthly_holding_cost
+    disposable_income = disposable_after_payoff - pmt
+
+    prep_months = params['prep_years_limit'] * 12
+    total_months = prep_months + num_mortgage_payments
+    acc_returns = get_return_tensor(params, total_months, 'accumulation')
+    post_returns = get_return_tensor(params, total_months, 'mortgage')
+
+    kernels = get_simulation_kernels()
+    net_worths, purchase_months, depleted_months = run_lifetime(
+        kernels, acc_returns, post_returns, params['initial_savings'], params['monthly_savings'], down_payment_amount,
+        prep_months, disposable_income, disposable_after_payoff, house_price, balances
+    )
+    purchased = purchase_months > 0
+
+    # 第一階段：準備期內的儲蓄軌跡，達標 (購屋) 後為 NaN
+    phase1_trajectories = net_worths[:, :prep_months + 1].copy()
+    phase1_trajectories[purchased[:, None] & (np.arange(prep_months + 1) > purchase_months[:, None])] = np.nan
+    if purchased.all():
+        phase1_trajectories = phase1_trajectories[:, :purchase_months.max() + 1]
+    phase1 = {
+        "success_rate": purchased.mean(),
+        "average_years": (purchase_months[purchased].mean() / 12) if purchased.any() else None,
+        "all_trajectories": phase1_trajectories,
+        "target_down_payment": down_payment_amount,
+        "engine": kernels['name']
+    }
 
-            disposable_income = params['monthly_income'] - params['monthly_expenses'] - pmt - monthly_holding_cost
-            financial_assets += disposable_income
-            monthly_return = np.random.normal(monthly_investment_return_mean, monthly_investment_return_std)
-            financial_assets *= (1 + monthly_return)
-            
-            interest_paid = remaining_loan * monthly_mortgage_rate
-            principal_paid = pmt - interest_paid
-            remaining_loan -= principal_paid
+    # 第二階段：自各路徑購屋月份起算的淨資產軌跡
+    if purchased.any():
+        owners = np.flatnonzero(purchased)
+        phase2_trajectories = net_worths[owners[:, None], purchase_months[owners, None] + np.arange(num_mortgage_payments + 1)]
+        owner_depleted_months = depleted_months[owners]
+        depleted = (owner_depleted_months > 0) & (owner_depleted_months <= num_mortgage_payments)
+        final_net_worths = phase2_trajectories[~depleted, -1]
+        phase2 = {
+            "monthly_mortgage_payment": pmt,
+            "monthly_holding_cost": monthly_holding_cost,
+            "asset_depletion_risk": depleted.mean(),
+            "all_net_worth_trajectories": phase2_trajectories,
+            "final_net_worths": final_net_worths,
+            "final_financial_assets": final_net_worths - house_price + max(0, balances[-1]),
+            "loan_amount": loan_amount,
+            "engine": kernels['name'],
+            "purchased_share": purchased.mean()
+        }
+    else:
+        phase2 = dict(simulate_mortgage_period(params), purchased_share=0.0)
+
+    # 跨階段統計：以今天為起點的固定年齡淨資產
+    current_age = params.get('current_age', 30)
+    age_stats = [
+        {'age': age, **summarize_final_values(net_worths[:, (age - current_age) * 12])}
+        for age in lifetime_report_ages(current_age, total_months)
+    ]
+    lifetime = {
+        "current_age": current_age,
+        "purchase_rate": purchased.mean(),
+        "median_purchase_age": (current_age + np.median(purchase_months[purchased]) / 12) if purchased.any() else None,
+        "depletion_rate": (depleted_months > 0).mean(),
+        "age_stats": age_stats,
+        "percentile_bands": dict(zip(SUMMARY_PERCENTILES, np.percentile(net_worths, SUMMARY_PERCENTILES, axis=0))),
+        "sample_paths": net_worths[:SUMMARY_SAMPLE_PATHS].copy()
+    }
+    return {'phase1': phase1, 'phase2': phase2, 'lifetime': lifetime}
+
+
+# --- 模擬結果記憶體管理 ---
+
+# 單一工作階段與全站的模擬結果記憶體上限 (MB)，可透過環境變數調整
+SESSION_RESULTS_BUDGET_BYTES = int(float(os.environ.get('HOUSING_SESSION_BUDGET_MB', 64)) * 1024 ** 2)
+GLOBAL_RESULTS_BUDGET_BYTES = int(float(os.environ.get('HOUSING_GLOBAL_BUDGET_MB', 512)) * 1024 ** 2)
+# 全站用量預設只寫入伺服器日誌；設定 HOUSING_SHOW_MEMORY_STATS=1 時才顯示於側邊欄 (供維運除錯)
+SHOW_MEMORY_STATS = os.environ.get('HOUSING_SHOW_MEMORY_STATS', '').lower() in ('1', 'true', 'yes')
+SUMMARY_SAMPLE_PATHS = 100  # 與圖表中繪製的樣本路徑數一致
+SUMMARY_PERCENTILES = (10, 50, 90)
+
+class SimulationResults(dict):
+    """存放於 session_state 的模擬結果；繼承 dict 以便全站登錄表以弱參照追蹤"""
+
+def format_bytes(num_bytes):
+    """將位元組數格式化為 KB / MB / GB"""
+    if num_bytes < 1024:
+        return f"{num_bytes:,.0f} B"
+    for unit in ('KB', 'MB', 'GB'):
+        num_bytes /= 1024
+        if num_bytes < 1024 or unit == 'GB':
+            return f"{num_bytes:,.1f} {unit}"
+
+def estimate_nbytes(obj):
+    """估算模擬結果物件佔用的記憶體位元組數 (含巢狀 list / dict / ndarray)"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_nbytes(k) + estimate_nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        size = sys.getsizeof(obj)
+        if obj and isinstance(obj[0], (int, float, np.floating)):
+            # 純數值序列：以第一個元素估算，避免逐一走訪上萬筆浮點數
+            return size + len(obj) * sys.getsizeof(obj[0])
+        return size + sum(estimate_nbytes(item) for item in obj)
+    return sys.getsizeof(obj)
+
+def summarize_trajectories(trajectories):
+    """將完整軌跡 (路徑 × 月份) 壓縮為逐月百分位數帶與少量樣本路徑"""
+    bands = {q: np.nanpercentile(trajectories, q, axis=0) for q in SUMMARY_PERCENTILES}
+    return bands, trajectories[:SUMMARY_SAMPLE_PATHS].copy()
+
+def summarize_final_values(values):
+    """期末數值的統計摘要"""
+    if len(values) == 0:
+        return {'count': 0, 'mean': None, 'median': None, 'p10': None, 'p90': None}
+    arr = np.asarray(values, dtype=float)
+    return {
+        'count': int(arr.size), 'mean': float(arr.mean()), 'median': float(np.median(arr)),
+        'p10': float(np.percentile(arr, 10)), 'p90': float(np.percentile(arr, 90))
+    }
 
-            current_net_worth = financial_assets + current_house_value - max(0, remaining_loan)
-            net_worth_trajectory.append(current_net_worth)
+def compact_simulation_results(results):
+    """將模擬結果降級為精簡摘要 (百分位數帶、樣本路徑、期末統計)，並就地更新"""
+    if results.get('compact') or results.get('evicted'):
+        return results
+    p1, p2 = dict(results['phase1']), dict(results['phase2'])
+    p1['percentile_bands'], p1['all_trajectories'] = summarize_trajectories(p1['all_trajectories'])
+    p2['percentile_bands'], p2['all_net_worth_trajectories'] = summarize_trajectories(p2['all_net_worth_trajectories'])
+    p2['final_net_worths'] = summarize_final_values(p2['final_net_worths'])
+    p2['final_financial_assets'] = summarize_final_values(p2['final_financial_assets'])
+    results.update({'phase1': p1, 'phase2': p2, 'compact': True})
+    return results
+
+def drop_simulation_results(results):
+    """釋放模擬結果，僅保留已被釋放的標記"""
+    results.pop('phase1', None)
+    results.pop('phase2', None)
+    results.pop('lifetime', None)
+    results['evicted'] = True
+    return results
+
+def get_median_final_financial_assets(p2_res):
+    """取得期末金融資產中位數，相容完整結果與精簡摘要"""
+    final_assets = p2_res['final_financial_assets']
+    if isinstance(final_assets, dict):
+        return final_assets['median'] or 0
+    return np.median(final_assets) if len(final_assets) else 0
+
+@st.cache_resource
+def get_results_registry():
+    """全站共用的模擬結果登錄表 (依最近使用時間排序)，並追蹤快取中的衝擊矩陣"""
+    return {'lock': threading.Lock(), 'sessions': OrderedDict(), 'tensors': {}}
+
+def register_shock_tensor(tensor):
+    """以弱參照登記快取的衝擊矩陣；被快取淘汰並回收後自動移除"""
+    tensors = get_results_registry()['tensors']
+    key = id(tensor)
+    tensors[key] = weakref.ref(tensor, lambda _: tensors.pop(key, None))
+
+def shock_tensor_cache_bytes():
+    """目前仍存活的快取衝擊矩陣總位元組數"""
+    return sum(tensor.nbytes for tensor in (ref() for ref in list(get_results_registry()['tensors'].values())) if tensor is not None)
+
+def snapshot_simulation_results(results):
+    """在登錄表的鎖內取得模擬結果的淺層快照。
+
+    其他工作階段的執行緒可能隨時壓縮或釋放本結果；壓縮與釋放只替換或移除頂層的鍵，
+    不修改各階段的內容，因此快照在之後的讀取過程中保持完整。
+    """
+    with get_results_registry()['lock']:
+        return SimulationResults(results)
+
+def govern_session_results(session_id, results):
+    """登記本工作階段的模擬結果，並依單一與全站記憶體上限進行壓縮或釋放。
+
+    超過單一工作階段上限時先降級為精簡摘要，仍超過則釋放；
+    全站總量 (含快取的衝擊矩陣) 超過上限時，自最久未使用的其他工作階段開始依序壓縮、釋放。
+    回傳目前的記憶體用量統計，以及在鎖內取得的結果快照 ('results')；
+    頁面應以快照繪製，避免其他工作階段在繪製途中釋放本結果。
+    """
+    registry = get_results_registry()
+    with registry['lock']:
+        sessions = registry['sessions']
+        entry = sessions.get(session_id)
+        is_new_results = entry is None or entry['ref']() is not results
+        if is_new_results:
+            nbytes = estimate_nbytes(results)
+            if nbytes > SESSION_RESULTS_BUDGET_BYTES:
+                compact_simulation_results(results)
+                nbytes = estimate_nbytes(results)
+                if nbytes > SESSION_RESULTS_BUDGET_BYTES:
+                    drop_simulation_results(results)
+                    nbytes = estimate_nbytes(results)
+            entry = {'ref': weakref.ref(results), 'nbytes': nbytes}
+            sessions[session_id] = entry
+        sessions.move_to_end(session_id)
+
+        # 清除已關閉工作階段留下的失效參照
+        for sid in [sid for sid, e in sessions.items() if e['ref']() is None]:
+            del sessions[sid]
+
+        total = sum(e['nbytes'] for e in sessions.values())
+        tensor_bytes = shock_tensor_cache_bytes()
+        for downgrade in (compact_simulation_results, drop_simulation_results):
+            for sid, e in list(sessions.items()):
+                if total + tensor_bytes <= GLOBAL_RESULTS_BUDGET_BYTES:
+                    break
+                other = e['ref']()
+                if sid == session_id or other is None or other.get('evicted'):
+                    continue
+                if downgrade is compact_simulation_results and other.get('compact'):
+                    continue  # 已是精簡摘要，留待釋放階段處理
+                downgrade(other)
+                new_nbytes = estimate_nbytes(other)
+                total += new_nbytes - e['nbytes']
+                e['nbytes'] = new_nbytes
+                print(f"Memory governor: {downgrade.__name__} applied to session {sid}, total now {format_bytes(total)}.")
+
+        if is_new_results:
+            print(f"Memory governor: session {session_id} registered {format_bytes(entry['nbytes'])}; "
+                  f"{len(sessions)} sessions hold {format_bytes(total)} + {format_bytes(tensor_bytes)} cached shocks "
+                  f"of {format_bytes(GLOBAL_RESULTS_BUDGET_BYTES)} budget.")
+
+        snapshot = SimulationResults(results)
+        return {
+            'session_bytes': entry['nbytes'], 'total_bytes': total, 'tensor_bytes': tensor_bytes, 'session_count': len(sessions),
+            'compact': bool(snapshot.get('compact')), 'evicted': bool(snapshot.get('evicted')), 'results': snapshot
+        }
 
-            if financial_assets < 0:
-                asset_depletion_count += 1
-                is_depleted = True
-        
-        if not is_depleted:
-            final_net_worths.append(net_worth_trajectory[-1])
-            final_financial_assets.append(financial_assets)
-        
-        all_net_worth_trajectories.append(net_worth_trajectory)
 
-    return {
-        "monthly_mortgage_payment": pmt,
-        "monthly_holding_cost": monthly_holding_cost,
-        "asset_depletion_risk": asset_depletion_count / params['simulations'],
-        "all_net_worth_trajectories": all_net_worth_trajectories,
-        "final_net_worths": final_net_worths,
-        "final_financial_assets": final_financial_assets,
-        "loan_amount": loan_amount
+# --- 模擬結果匯出與載入 ---
+
+APP_VERSION = 'v4.0'
+ARCHIVE_FORMAT_VERSION = 1
+PHASE1_SCALAR_KEYS = ('success_rate', 'average_years', 'target_down_payment', 'engine')
+PHASE2_SCALAR_KEYS = ('monthly_mortgage_payment', 'monthly_holding_cost', 'asset_depletion_risk', 'loan_amount', 'engine', 'purchased_share')
+LIFETIME_SCALAR_KEYS = ('current_age', 'purchase_rate', 'median_purchase_age', 'depletion_rate', 'age_stats')
+
+def save_simulation_archive(results, params, target, compress=True):
+    """將模擬結果存成 NumPy 封存檔 (.npz)，供日後免重算直接載入。
+
+    內容包含參數、隨機種子、引擎版本、摘要指標，以及 float32 的百分位數帶與樣本路徑 (含全程整合模擬的跨階段結果)。
+    compress=False 時以不壓縮方式儲存，之後可用 mmap=True 以記憶體映射方式載入。
+    """
+    compact = compact_simulation_results(SimulationResults(results))  # 不影響原本的結果
+    p1, p2 = compact['phase1'], compact['phase2']
+    meta = {
+        'format_version': ARCHIVE_FORMAT_VERSION,
+        'engine_version': f"{APP_VERSION}/{p1.get('engine', 'python')}",
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'params': params,
+        'seed': params.get('random_seed'),
+        'percentiles': list(SUMMARY_PERCENTILES),
+        'phase1': {key: p1.get(key) for key in PHASE1_SCALAR_KEYS},
+        'phase2': {key: p2.get(key) for key in PHASE2_SCALAR_KEYS},
+        'final_net_worths': p2['final_net_worths'],
+        'final_financial_assets': p2['final_financial_assets'],
+    }
+    lifetime = compact.get('lifetime')
+    if lifetime:
+        meta['lifetime'] = {key: lifetime.get(key) for key in LIFETIME_SCALAR_KEYS}
+    arrays = {
+        'meta': np.array(json.dumps(meta, ensure_ascii=False, default=float)),
+        'phase1_bands': np.array([p1['percentile_bands'][q] for q in SUMMARY_PERCENTILES], dtype=np.float32),
+        'phase1_samples': np.asarray(p1['all_trajectories'], dtype=np.float32),
+        'phase2_bands': np.array([p2['percentile_bands'][q] for q in SUMMARY_PERCENTILES], dtype=np.float32),
+        'phase2_samples': np.asarray(p2['all_net_worth_trajectories'], dtype=np.float32),
     }
+    if lifetime:
+        arrays['lifetime_bands'] = np.array([lifetime['percentile_bands'][q] for q in SUMMARY_PERCENTILES], dtype=np.float32)
+        arrays['lifetime_samples'] = np.asarray(lifetime['sample_paths'], dtype=np.float32)
+    (np.savez_compressed if compress else np.savez)(target, **arrays)
+
+def make_archive_builder(results, params, compress=True):
+    """回傳於呼叫時才產生封存檔內容的函式，供下載按鈕延後產生，避免每次重新執行腳本都計算與壓縮"""
+    def build():
+        snapshot = snapshot_simulation_results(results)
+        if snapshot.get('evicted'):
+            raise ValueError("模擬結果已因伺服器記憶體限制被釋放，請重新執行模擬分析。")
+        buffer = io.BytesIO()
+        save_simulation_archive(snapshot, params, buffer, compress=compress)
+        return buffer.getvalue()
+    return build
+
+def is_uncompressed_archive(path):
+    """封存檔內的所有陣列是否皆未壓縮 (可記憶體映射)"""
+    with zipfile.ZipFile(path) as archive:
+        return all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+
+def memmap_npz_members(path):
+    """以記憶體映射方式開啟未壓縮 .npz 內的各陣列，不將資料讀入記憶體"""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"'{info.filename}' 為壓縮格式，無法以記憶體映射方式載入。")
+            # 本地檔頭為 30 bytes 固定欄位，後接檔名與額外欄位
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            key = info.filename[:-len('.npy')]
+            if dtype.hasobject or dtype.kind == 'U':
+                # 文字型 (meta) 直接讀取，體積很小
+                arrays[key] = np.lib.format.read_array(archive.open(info), allow_pickle=False)
+            else:
+                arrays[key] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+def load_simulation_archive(source, mmap=None):
+    """載入模擬結果封存檔，回傳 (參數, SimulationResults)。
+
+    source 可為路徑或檔案物件。source 為未壓縮封存檔的路徑時，預設 (mmap=None) 即以記憶體映射方式
+    存取百分位數帶與樣本路徑，適合大型封存檔；mmap=True 時要求記憶體映射，壓縮檔會引發錯誤；
+    mmap=False 則一律讀入記憶體。檔案物件 (例如上傳的檔案) 本身已在記憶體中，一律直接讀取。
+    """
+    is_path = isinstance(source, (str, os.PathLike))
+    if mmap is None:
+        mmap = is_path and is_uncompressed_archive(source)
+    if mmap and is_path:
+        arrays = memmap_npz_members(source)
+    else:
+        with np.load(source, allow_pickle=False) as archive:
+            arrays = {key: archive[key] for key in archive.files}
+    meta = json.loads(str(arrays['meta']))
+    if meta.get('format_version') != ARCHIVE_FORMAT_VERSION:
+        raise ValueError(f"不支援的模擬結果檔版本：{meta.get('format_version')}")
+    if meta['params']['prep_years_limit'] > MAX_PREP_YEARS or meta['params']['mortgage_years'] not in MORTGAGE_YEAR_OPTIONS:
+        raise ValueError("模擬結果檔的準備年期或房貸年期超出目前可選的範圍。")
+
+    percentiles = meta['percentiles']
+    phase1 = dict(meta['phase1'])
+    phase1['percentile_bands'] = dict(zip(percentiles, arrays['phase1_bands']))
+    phase1['all_trajectories'] = arrays['phase1_samples']
+    phase2 = dict(meta['phase2'])
+    phase2['percentile_bands'] = dict(zip(percentiles, arrays['phase2_bands']))
+    phase2['all_net_worth_trajectories'] = arrays['phase2_samples']
+    phase2['final_net_worths'] = meta['final_net_worths']
+    phase2['final_financial_assets'] = meta['final_financial_assets']
+    results = SimulationResults(phase1=phase1, phase2=phase2, compact=True, archive_meta={
+        key: meta[key] for key in ('engine_version', 'created_at', 'seed')
+    })
+    if 'lifetime' in meta:
+        lifetime = dict(meta['lifetime'])
+        lifetime['percentile_bands'] = dict(zip(percentiles, arrays['lifetime_bands']))
+        lifetime['sample_paths'] = arrays['lifetime_samples']
+        results['lifetime'] = lifetime
+    return meta['params'], results
 
 
 # --- 圖表產生函式 ---
@@ -243,17 +874,16 @@ def plot_cost_benefit_analysis(costs, benefits):
     
     return fig
 
-def plot_accumulation_chart(trajectories, target, years_limit, title):
+def plot_accumulation_chart(trajectories, target, years_limit, title, median_trajectory=None):
     fig, ax = plt.subplots(figsize=(10, 6))
     ax.set_title(title, fontsize=16, pad=20)
     ax.set_xlabel('準備年期 (年)', fontsize=12)
     ax.set_ylabel('累積資產 (萬元)', fontsize=12)
     for trajectory in trajectories[:100]:
         years_axis = np.arange(len(trajectory)) / 12
-        ax.plot(years_axis, np.array(trajectory) / 10000, color='gray', alpha=0.2)
-    max_len = max(len(t) for t in trajectories) if trajectories else 0
-    padded_trajectories = [t + [np.nan] * (max_len - len(t)) for t in trajectories]
-    median_trajectory = np.nanmedian(padded_trajectories, axis=0)
+        ax.plot(years_axis, trajectory / 10000, color='gray', alpha=0.2)
+    if median_trajectory is None:
+        median_trajectory = np.nanmedian(trajectories, axis=0)
     years_axis_median = np.arange(len(median_trajectory)) / 12
     ax.plot(years_axis_median, median_trajectory / 10000, color='blue', linewidth=2.5, label='資產中位數')
     ax.axhline(y=target / 10000, color='green', linestyle='--', label=f'目標金額: {format_large_number(target)}')
@@ -263,17 +893,16 @@ def plot_accumulation_chart(trajectories, target, years_limit, title):
     fig.tight_layout()
     return fig
 
-def plot_net_worth_chart(trajectories, years, title):
+def plot_net_worth_chart(trajectories, years, title, median_trajectory=None):
     fig, ax = plt.subplots(figsize=(10, 6))
     ax.set_title(title, fontsize=16, pad=20)
     ax.set_xlabel('持有年期 (年)', fontsize=12)
     ax.set_ylabel('總淨資產 (萬元)', fontsize=12)
     for trajectory in trajectories[:100]:
         years_axis = np.arange(len(trajectory)) / 12
-        ax.plot(years_axis, np.array(trajectory) / 10000, color='gray', alpha=0.2)
-    max_len = max(len(t) for t in trajectories) if trajectories else 0
-    padded_trajectories = [t + [np.nan] * (max_len - len(t)) for t in trajectories]
-    median_trajectory = np.nanmedian(padded_trajectories, axis=0)
+        ax.plot(years_axis, trajectory / 10000, color='gray', alpha=0.2)
+    if median_trajectory is None:
+        median_trajectory = np.nanmedian(trajectories, axis=0)
     years_axis_median = np.arange(len(median_trajectory)) / 12
     ax.plot(years_axis_median, median_trajectory / 10000, color='red', linewidth=2.5, label='淨資產中位數')
     ax.set_xlim(0, years)
@@ -282,6 +911,24 @@ def plot_net_worth_chart(trajectories, years, title):
     fig.tight_layout()
     return fig
 
+def plot_lifetime_chart(sample_paths, percentile_bands, current_age, title):
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.set_title(title, fontsize=16, pad=20)
+    ax.set_xlabel('年齡 (歲)', fontsize=12)
+    ax.set_ylabel('總淨資產 (萬元)', fontsize=12)
+    for trajectory in sample_paths[:100]:
+        ages_axis = current_age + np.arange(len(trajectory)) / 12
+        ax.plot(ages_axis, trajectory / 10000, color='gray', alpha=0.2)
+    low, median, high = (np.asarray(percentile_bands[q]) for q in SUMMARY_PERCENTILES)
+    ages_axis = current_age + np.arange(len(median)) / 12
+    ax.fill_between(ages_axis, low / 10000, high / 10000, color='purple', alpha=0.15, label=f'第 {SUMMARY_PERCENTILES[0]}-{SUMMARY_PERCENTILES[-1]} 百分位數')
+    ax.plot(ages_axis, median / 10000, color='purple', linewidth=2.5, label='淨資產中位數')
+    ax.set_xlim(current_age, ages_axis[-1])
+    ax.grid(True, linestyle='--', alpha=0.6)
+    ax.legend(fontsize=10)
+    fig.tight_layout()
+    return fig
+
 # --- PDF 產生函式 ---
 class PDF(FPDF):
     def __init__(self, *args, **kwargs):
@@ -355,11 +1002,20 @@ def create_pdf_report(params, texts, figs):
         pdf.chapter_body("淨資產成長軌跡：")
         pdf.image(figs['phase2_chart_path'], x=10, y=None, w=190)
 
-    # 第4頁: 參數與聲明
+    # 第4頁: 跨階段的生涯淨資產分析 (僅全程整合模擬的結果提供)
+    chapter_numbers = iter(['四', '五', '六'])
+    if texts.get('lifetime_analysis'):
+        pdf.add_page()
+        pdf.chapter_title(f'{next(chapter_numbers)}、生涯淨資產分析')
+        pdf.chapter_body(texts['lifetime_analysis'])
+        if os.path.exists(figs.get('lifetime_chart_path', '')):
+            pdf.image(figs['lifetime_chart_path'], x=10, y=None, w=190)
+
+    # 最後一頁: 參數與聲明
     pdf.add_page()
-    pdf.chapter_title('四、本次模擬參數回顧')
+    pdf.chapter_title(f'{next(chapter_numbers)}、本次模擬參數回顧')
     pdf.chapter_body(texts['params'])
-    pdf.chapter_title('五、名詞解釋與免責聲明')
+    pdf.chapter_title(f'{next(chapter_numbers)}、名詞解釋與免責聲明')
     pdf.chapter_body(texts['disclaimer'])
     
     return bytes(pdf.output())
@@ -426,7 +1082,7 @@ if page == "📖 設計理念與使用說明":
         - `目標房屋總價`、`頭期款比例`、`房貸年期` 是您購屋計畫的核心。
         - `房貸利率`、`房屋年持有成本比例` 是影響您長期支出的關鍵。
     **第二步：執行模擬並解讀結果**
-    點擊「執行模擬分析」後，請依序查看右側的三個分頁：
+    點擊「執行模擬分析」後，請依序查看右側的四個分頁：
     1.  **📊 總結與建議**：
         - **優先查看！** 這裡提供了對您計畫兩個階段的總體評估（穩健、存在挑戰、壓力過高等）。
         - **財務壓力儀表板**會直觀地顯示您購屋後的現金流健康狀況。
@@ -437,6 +1093,9 @@ if page == "📖 設計理念與使用說明":
     3.  **📉 房貸與持有期分析**：
         - **每月現金流儀表板**詳細拆解了您買房後的收支結構，讓您清楚知道錢花在哪，以及每月還能剩下多少錢可以再投資。
         - **購屋總成本及淨值效益分析**則計算了您在整個房貸期間的總支出，以及最終可能累積的資產。這是評估「房子究竟是資產還是負債」的關鍵數據。
+    4.  **🧭 生涯淨資產分析**：
+        - 每條模擬路徑在同一個市場情境下，從存頭期款、於達標當月購屋，一路走到房貸清償，存到的額外儲蓄也會一併帶入購屋後的資產。
+        - 這裡呈現您在 40 歲、50 歲、60 歲等固定年齡時的淨資產分佈，讓您看見「何時買得起」與「買了之後過得如何」的整體結果。
     **第三步：反覆測試與優化**
     財務規劃是一個動態調整的過程。請不要只滿足於一次的模擬結果。嘗試調整不同的參數組合，例如：
     - 「如果我多準備兩年，成功率會提高多少？」
@@ -455,7 +1114,9 @@ if 'params' not in st.session_state:
         'monthly_expenses': 25000, 'target_house_price': 15000000, 'down_payment_ratio': 0.20,
         'prep_years_limit': 10, 'mortgage_years': 30, 'annual_return_mean': 0.08,
         'annual_return_std': 0.16, 'mortgage_rate': 0.022, 'annual_holding_cost_ratio': 0.006,
-        'post_purchase_return_mean': 0.06, 'post_purchase_return_std': 0.14, 'simulations': 2000
+        'post_purchase_return_mean': 0.06, 'post_purchase_return_std': 0.14, 'simulations': 2000,
+        'market_model': 'normal', 'random_seed': int(np.random.default_rng().integers(1_000_000)),
+        'current_age': 30
     }
 
 # --- 複合式輸入元件函式 ---
@@ -477,10 +1138,11 @@ with st.sidebar:
     st.info("大部分滑桿旁都有數字輸入框，方便精確調整。")
     with st.expander("第一階段：頭期款準備期", expanded=True):
         st.subheader("個人財務")
+        st.session_state.params['current_age'] = st.number_input("目前年齡", min_value=18, max_value=70, value=st.session_state.params['current_age'], step=1, format="%d", help="用於換算各年齡時的淨資產，例如 50 歲、60 歲時的財富分佈。")
         st.session_state.params['initial_savings'] = st.number_input("目前購屋儲蓄", min_value=0, value=st.session_state.params['initial_savings'], step=50000, format="%d", help="您目前已經為購屋準備的存款或投資資產總額。")
         st.session_state.params['monthly_savings'] = st.number_input("每月預計投入儲蓄", min_value=0, value=st.session_state.params['monthly_savings'], step=1000, format="%d", help="每月預計能為購屋目標投入的儲蓄金額。建議：應在不影響生活品質下，盡量提高。")
         st.subheader("準備期目標")
-        st.session_state.params['prep_years_limit'] = st.slider("最長準備年期 (年)", 1, 20, st.session_state.params['prep_years_limit'], 1, help="您給自己準備頭期款的最長期限。建議：可依據您的年齡與生涯規劃設定。")
+        st.session_state.params['prep_years_limit'] = st.slider("最長準備年期 (年)", 1, MAX_PREP_YEARS, st.session_state.params['prep_years_limit'], 1, help="您給自己準備頭期款的最長期限。建議：可依據您的年齡與生涯規劃設定。")
         st.subheader("市場假設 (準備期)")
         create_slider_input("年化平均報酬率", 1.0, 15.0, 'annual_return_mean', "%", "儲蓄期間，您投資組合的長期年化『平均』報酬率預期。\n\n參考：全球股市長期約8%-10%，債券約2%-4%，可依您的股債配置比例估算。", "%.1f", 0.5)
         create_slider_input("年化報酬波動率", 5.0, 30.0, 'annual_return_std', "% ", "報酬率的波動程度(風險)。\n\n參考：全球股市約15%-20%。波動率越高，達標時間的不確定性越大。", "%.1f", 0.5)
@@ -496,34 +1158,81 @@ with st.sidebar:
         st.session_state.params['target_house_price'] = st.number_input("目標房屋總價", min_value=0, value=st.session_state.params['target_house_price'], step=100000, format="%d", help="您預計購買的房屋總價。")
         create_slider_input("預計頭期款比例", 10.0, 50.0, 'down_payment_ratio', "%", "頭期款佔房屋總價的比例。\n\n建議：台灣普遍為20%-30%，若能提高，可有效降低總貸金額與月付金。", "%.1f", 1.0)
         st.caption(f"↳ 頭期款金額： **{format_large_number(st.session_state.params['target_house_price'] * st.session_state.params['down_payment_ratio'])}** 元")
-        st.session_state.params['mortgage_years'] = st.select_slider("房貸年期 (年)", options=[20, 30, 40], value=st.session_state.params['mortgage_years'], help="常見房貸年期。年期越長，月付金越低，但總利息支出越高。")
+        st.session_state.params['mortgage_years'] = st.select_slider("房貸年期 (年)", options=MORTGAGE_YEAR_OPTIONS, value=st.session_state.params['mortgage_years'], help="常見房貸年期。年期越長，月付金越低，但總利息支出越高。")
         st.subheader("貸款與持有成本")
         create_slider_input("房貸利率", 1.0, 5.0, 'mortgage_rate', "%", "預估的房貸利率。\n\n參考：可參考近期銀行牌告利率或政府優惠貸款利率(如新青安，2024年約2.2%)。", "%.2f", 0.05)
         create_slider_input("房屋年持有成本比例", 0.1, 2.0, 'annual_holding_cost_ratio', "% ", "預估每年花在房屋上的成本佔房價的比例，包含房屋稅、地價稅、管理費、保險、預期修繕費等。\n\n建議：一般估算為房價的0.5%-1.0%。", "%.2f", 0.05)
         st.caption(f"↳ 預估年持有成本： **{format_large_number(st.session_state.params['target_house_price'] * st.session_state.params['annual_holding_cost_ratio'])}** 元")
     st.subheader("模擬設定")
     st.session_state.params['simulations'] = st.select_slider("模擬次數", options=[1000, 2000, 5000, 10000], value=st.session_state.params['simulations'], help="次數越多結果越穩定，但計算較久。")
+    model_options = available_return_models()
+    if st.session_state.params['market_model'] not in model_options:
+        st.session_state.params['market_model'] = 'normal'
+    st.session_state.params['market_model'] = st.selectbox("市場報酬模型", options=model_options, index=model_options.index(st.session_state.params['market_model']), format_func=lambda key: RETURN_MODELS[key]['label'], help="產生每月投資報酬率的方式。\n\n常態分配：最基本的假設。\n\n肥尾分配：極端漲跌更常出現。\n\n多空狀態轉換：模擬市場在平穩期與高波動空頭之間切換。\n\n歷史區塊拔靴法：自歷史報酬資料中抽取連續區塊 (需提供歷史資料檔)。")
+    st.session_state.params['random_seed'] = st.number_input("隨機種子", min_value=0, value=st.session_state.params['random_seed'], step=1, format="%d", help="相同的種子與市場假設會產生相同的市場情境，調整收入、房價等參數時可直接比較結果；更換種子即可抽樣新的市場情境。")
     if st.button("🚀 執行模擬分析", type="primary", use_container_width=True):
         st.session_state.run_simulation = True
         st.session_state.suggestion_adopted = False # 清除建議提示
+    with st.expander("📂 載入先前的模擬結果"):
+        archive_file = st.file_uploader("模擬結果檔 (.npz)", type=['npz'], help="載入先前下載的模擬結果檔，直接檢視當時的參數、分析與PDF報告，不需重新計算。")
+        if archive_file is not None and st.button("載入並顯示結果", use_container_width=True):
+            try:
+                loaded_params, loaded_results = load_simulation_archive(archive_file)
+            except (ValueError, KeyError, OSError, zipfile.BadZipFile) as e:
+                st.error(f"無法載入模擬結果檔：{e}")
+            else:
+                st.session_state.params.update(loaded_params)
+                st.session_state.simulation_results = loaded_results
+                st.session_state.run_simulation = False
+                st.rerun()
 
 # --- 主畫面顯示 ---
 
 if st.session_state.get('run_simulation', False):
-    with st.spinner('🤖 正在為您執行蒙地卡羅模擬...請稍候...'):
-        phase1_results = simulate_down_payment(st.session_state.params)
-        phase2_results = simulate_mortgage_period(st.session_state.params)
-        st.session_state.simulation_results = {'phase1': phase1_results, 'phase2': phase2_results}
-    st.success('模擬完成！')
+    try:
+        with st.spinner('🤖 正在為您執行蒙地卡羅模擬...請稍候...'):
+            # 全程整合模擬：每條路徑於首次達標的月份購屋，並延續剩餘儲蓄進入房貸期
+            st.session_state.simulation_results = SimulationResults(**simulate_lifetime(st.session_state.params))
+    except ValueError as e:
+        st.error(f"無法執行模擬：{e}")
+    else:
+        st.success('模擬完成！')
     st.session_state.run_simulation = False
 
+# --- 記憶體管理：登記本工作階段結果並回報用量 ---
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'simulation_results' in st.session_state:
+    memory_usage = govern_session_results(st.session_state.session_id, st.session_state.simulation_results)
+    results_view = memory_usage['results']  # 本次繪製一律使用快照
+    memory_caption = (
+        f"🧠 本次結果佔用 {format_bytes(memory_usage['session_bytes'])}"
+        f"{' (已釋放)' if memory_usage['evicted'] else ' (已壓縮為摘要)' if memory_usage['compact'] else ''}"
+    )
+    if SHOW_MEMORY_STATS:
+        memory_caption += (
+            f"；全站 {memory_usage['session_count']} 個工作階段共 {format_bytes(memory_usage['total_bytes'])}"
+            f" + 報酬率快取 {format_bytes(memory_usage['tensor_bytes'])}"
+            f" / 上限 {format_bytes(GLOBAL_RESULTS_BUDGET_BYTES)}；運算核心 {get_simulation_kernels()['name']}"
+        )
+    st.sidebar.caption(memory_caption)
+    if memory_usage['evicted']:
+        del st.session_state.simulation_results
+        st.warning("因伺服器記憶體限制，先前的模擬結果已被釋放，請重新執行模擬分析。")
+
 if 'simulation_results' in st.session_state:
     params = st.session_state.params
-    p1_res = st.session_state.simulation_results['phase1']
-    p2_res = st.session_state.simulation_results['phase2']
+    p1_res = results_view['phase1']
+    p2_res = results_view['phase2']
     financial_stress_index = (p2_res['monthly_mortgage_payment'] + p2_res['monthly_holding_cost']) / params['monthly_income'] if params['monthly_income'] > 0 else 0
 
-    tab1, tab2, tab3 = st.tabs(["📊 總結與建議", "📈 頭期款準備分析", "📉 房貸與持有期分析"])
+    archive_meta = results_view.get('archive_meta')
+    if archive_meta:
+        st.info(f"📂 目前顯示的是 {archive_meta['created_at']} 儲存的模擬結果 (引擎 {archive_meta['engine_version']}，種子 {archive_meta['seed']})，未重新計算。")
+
+    lt_res = results_view.get('lifetime')
+
+    tab1, tab2, tab3, tab4 = st.tabs(["📊 總結與建議", "📈 頭期款準備分析", "📉 房貸與持有期分析", "🧭 生涯淨資產分析"])
 
     with tab1:
         st.header("總體財務評估")
@@ -575,14 +1284,15 @@ if 'simulation_results' in st.session_state:
                         st.markdown(f"<p style='color:green;'>➔ 提高達標率</p>", unsafe_allow_html=True)
                         if st.button("採納 A", key="optA", use_container_width=True): handle_suggestion_click({'monthly_savings': new_savings})
                 col_idx += 1
-                with cols[col_idx % 3]:
-                    with st.container(border=True, height=200):
-                        st.markdown("###### **方案B: 延長準備期**")
-                        new_prep_years = params['prep_years_limit'] + 2
-                        st.markdown(f"延長2年至 **{new_prep_years}** 年。")
-                        st.markdown(f"<p style='color:green;'>➔ 爭取複利時間</p>", unsafe_allow_html=True)
-                        if st.button("採納 B", key="optB", use_container_width=True): handle_suggestion_click({'prep_years_limit': new_prep_years})
-                col_idx += 1
+                new_prep_years = min(params['prep_years_limit'] + 2, MAX_PREP_YEARS)
+                if new_prep_years > params['prep_years_limit']:
+                    with cols[col_idx % 3]:
+                        with st.container(border=True, height=200):
+                            st.markdown("###### **方案B: 延長準備期**")
+                            st.markdown(f"延長{new_prep_years - params['prep_years_limit']}年至 **{new_prep_years}** 年。")
+                            st.markdown(f"<p style='color:green;'>➔ 爭取複利時間</p>", unsafe_allow_html=True)
+                            if st.button("採納 B", key="optB", use_container_width=True): handle_suggestion_click({'prep_years_limit': new_prep_years})
+                    col_idx += 1
             
             if not p2_success:
                 with cols[col_idx % 3]:
@@ -634,14 +1344,22 @@ if 'simulation_results' in st.session_state:
         m_col1, m_col2 = st.columns(2)
         m_col1.metric(f"在 {params['prep_years_limit']} 年內達標的機率", f"{p1_res['success_rate']:.1%}")
         m_col2.metric("成功者的平均達標時間", f"{p1_res['average_years']:.1f} 年" if p1_res['average_years'] else "N/A")
-        fig1 = plot_accumulation_chart(p1_res['all_trajectories'], p1_res['target_down_payment'], params['prep_years_limit'], '頭期款財富累積軌跡')
+        fig1 = plot_accumulation_chart(p1_res['all_trajectories'], p1_res['target_down_payment'], params['prep_years_limit'], '頭期款財富累積軌跡', median_trajectory=p1_res.get('percentile_bands', {}).get(50))
         st.pyplot(fig1)
 
     with tab3:
         st.header("房貸與持有期分析")
+        phase2_scope_note = ""
+        if 'purchased_share' in p2_res:
+            if p2_res['purchased_share'] > 0:
+                phase2_scope_note = f"以下結果涵蓋在準備期內成功購屋的 {p2_res['purchased_share']:.1%} 模擬路徑，自各自的購屋月份起算，超出頭期款的儲蓄延續為購屋後的金融資產。"
+                st.caption(phase2_scope_note)
+            else:
+                phase2_scope_note = f"沒有任何模擬路徑能在 {params['prep_years_limit']} 年內存到頭期款。以下為假設今天即以頭期款購屋、購屋後沒有其他金融資產的情境，僅供參考，並非您的計畫所能達成的結果。"
+                st.warning(phase2_scope_note)
 
         monthly_surplus = params['monthly_income'] - p2_res['monthly_mortgage_payment'] - p2_res['monthly_holding_cost'] - params['monthly_expenses']
-        median_final_financial_assets = np.median(p2_res['final_financial_assets']) if p2_res['final_financial_assets'] else 0
+        median_final_financial_assets = get_median_final_financial_assets(p2_res)
         final_house_value = params['target_house_price']
         median_final_net_worth = final_house_value + median_final_financial_assets
         loan_amount = p2_res['loan_amount']
@@ -703,9 +1421,39 @@ if 'simulation_results' in st.session_state:
             st.caption("此計算為「最終總淨資產」減去「真實購屋總成本」，結果為正代表資產增長超過總支出，反之則代表總支出高於資產增長。")
 
         st.subheader("淨資產成長軌跡")
-        fig2 = plot_net_worth_chart(p2_res['all_net_worth_trajectories'], params['mortgage_years'], '持有期總淨資產成長軌跡')
+        fig2 = plot_net_worth_chart(p2_res['all_net_worth_trajectories'], params['mortgage_years'], '持有期總淨資產成長軌跡', median_trajectory=p2_res.get('percentile_bands', {}).get(50))
         st.pyplot(fig2)
 
+    with tab4:
+        st.header("生涯淨資產分析")
+        fig_lifetime = None
+        lifetime_text = ""
+        if lt_res:
+            median_purchase_age_text = f"{lt_res['median_purchase_age']:.1f} 歲" if lt_res['median_purchase_age'] is not None else "N/A"
+            lifetime_text = f"""
+從 **{lt_res['current_age']}** 歲開始，每條模擬路徑在同一個市場情境下依序經歷儲蓄、在首次存到頭期款的月份購屋、以及 **{params['mortgage_years']}** 年的房貸期；房貸清償後，每月結餘持續投入投資。
+- **購屋機率**：有 **{lt_res['purchase_rate']:.1%}** 的路徑能在 **{params['prep_years_limit']}** 年內購屋，購屋年齡中位數為 **{median_purchase_age_text}**。
+- **金融資產耗盡機率**：全部路徑中，有 **{lt_res['depletion_rate']:.1%}** 在購屋後的某個時點耗盡金融資產。
+"""
+            st.markdown(lifetime_text)
+            m_col1, m_col2, m_col3 = st.columns(3)
+            m_col1.metric("購屋機率", f"{lt_res['purchase_rate']:.1%}")
+            m_col2.metric("購屋年齡中位數", median_purchase_age_text)
+            m_col3.metric("購屋後資產耗盡機率", f"{lt_res['depletion_rate']:.1%}")
+
+            st.subheader("各年齡的總淨資產分佈")
+            age_rows = [
+                {'年齡': f"{row['age']} 歲", '悲觀 (第10百分位)': format_large_number(row['p10']), '中位數': format_large_number(row['median']), '樂觀 (第90百分位)': format_large_number(row['p90'])}
+                for row in lt_res['age_stats']
+            ]
+            st.table(age_rows)
+            st.caption("總淨資產 = 金融資產 + 房屋價值 - 剩餘房貸；尚未購屋的路徑則為累積的儲蓄。")
+
+            fig_lifetime = plot_lifetime_chart(lt_res['sample_paths'], lt_res['percentile_bands'], lt_res['current_age'], '生涯總淨資產軌跡')
+            st.pyplot(fig_lifetime)
+        else:
+            st.info("此模擬結果未包含生涯淨資產分析，請重新執行模擬分析。")
+
     # --- PDF 報告生成與下載區塊 ---
     st.write("---")
     st.header("📥 下載完整報告")
@@ -720,11 +1468,11 @@ if 'simulation_results' in st.session_state:
 在您的規劃中，計畫於 {params['prep_years_limit']} 年內，從 {format_large_number(params['initial_savings'])} 元的本金開始，每月投入 {format_large_number(params['monthly_savings'])} 元，來達成 {format_large_number(p1_res['target_down_payment'])} 元的頭期款目標。
 根據我們的模擬分析，關鍵成果如下：
 - 在 {params['prep_years_limit']} 年內達標的機率: {p1_res['success_rate']:.1%}
-- 成功者的平均達標時間: {p1_res['average_years']:.1f} 年 (此為成功達標模擬路徑的平均值)
+- 成功者的平均達標時間: {f"{p1_res['average_years']:.1f} 年" if p1_res['average_years'] else "N/A"} (此為成功達標模擬路徑的平均值)
 """
         pdf_phase1_analysis = strip_markdown_for_pdf(phase1_text_for_pdf)
         
-        phase2_main_text = strip_markdown_for_pdf(phase2_text)
+        phase2_main_text = strip_markdown_for_pdf(f"{phase2_scope_note}\n{phase2_text}" if phase2_scope_note else phase2_text)
         cash_flow_summary = f"""
 每月現金流儀表板摘要:
 - 每月稅後總收入: {format_large_number(params['monthly_income'])} 元
@@ -744,6 +1492,8 @@ if 'simulation_results' in st.session_state:
         for key, value in params.items():
             if key in ['initial_savings', 'monthly_savings', 'monthly_income', 'monthly_expenses', 'target_house_price']:
                 params_text_list.append(f"- {key}: {format_large_number(value)} 元")
+            elif key == 'market_model':
+                params_text_list.append(f"- {key}: {RETURN_MODELS[value]['label']}")
             elif key.endswith('_ratio') or key.endswith('_rate') or 'return' in key:
                  params_text_list.append(f"- {key}: {value:.2%}")
             elif key == 'simulations':
@@ -759,20 +1509,32 @@ if 'simulation_results' in st.session_state:
             'phase1_analysis': pdf_phase1_analysis, 'phase2_analysis': pdf_phase2_analysis,
             'params': params_text, 'disclaimer': disclaimer_text
         }
+        if lt_res:
+            age_lines = "\n".join(
+                f"- {row['age']} 歲：中位數 {format_large_number(row['median'])} 元 (第10百分位 {format_large_number(row['p10'])} 元，第90百分位 {format_large_number(row['p90'])} 元)"
+                for row in lt_res['age_stats']
+            )
+            texts_for_pdf['lifetime_analysis'] = strip_markdown_for_pdf(lifetime_text) + f"\n\n各年齡的總淨資產分佈:\n{age_lines}"
+
         
-        # 2. 儲存所有需要的圖表
+        # 2. 儲存所有需要的圖表 (每次執行使用獨立的暫存目錄，避免多個工作階段互相覆寫)
         fig_paths = {}
+        fig_dir = tempfile.mkdtemp(prefix='housing_figs_')
         try:
             fig_paths = {
                 'phase1_chart_path': 'phase1_chart.png', 'phase2_chart_path': 'phase2_chart.png',
                 'stress_gauge_path': 'stress_gauge.png', 'cost_benefit_path': 'cost_benefit.png',
                 'cash_flow_pie_path': 'cash_flow_pie.png'
             }
+            fig_paths = {key: os.path.join(fig_dir, name) for key, name in fig_paths.items()}
             fig1.savefig(fig_paths['phase1_chart_path'], dpi=300, bbox_inches='tight')
             fig2.savefig(fig_paths['phase2_chart_path'], dpi=300, bbox_inches='tight')
             stress_gauge_fig.savefig(fig_paths['stress_gauge_path'], dpi=300, bbox_inches='tight')
             fig_cost_benefit.savefig(fig_paths['cost_benefit_path'], dpi=300, bbox_inches='tight')
             fig_pie.savefig(fig_paths['cash_flow_pie_path'], dpi=300, bbox_inches='tight')
+            if fig_lifetime is not None:
+                fig_paths['lifetime_chart_path'] = os.path.join(fig_dir, 'lifetime_chart.png')
+                fig_lifetime.savefig(fig_paths['lifetime_chart_path'], dpi=300, bbox_inches='tight')
             
             # 3. 生成 PDF
             pdf_data = create_pdf_report(params, texts_for_pdf, fig_paths)
@@ -782,11 +1544,24 @@ if 'simulation_results' in st.session_state:
                 file_name=f"Home_Purchase_Plan_v4.0_{datetime.now().strftime('%Y%m%d')}.pdf", 
                 mime="application/pdf", use_container_width=True
             )
+
+            # 同時提供模擬結果檔，日後可直接載入檢視，不需重新計算；檔案於點擊下載時才產生
+            archive_uncompressed = st.checkbox("以未壓縮格式下載模擬結果檔", help="檔案較大，但以程式載入時可用 mmap=True 記憶體映射存取，不需將資料讀入記憶體。")
+            st.download_button(
+                label="下載模擬結果檔 (可日後載入，免重新計算)",
+                data=make_archive_builder(st.session_state.simulation_results, dict(params), compress=not archive_uncompressed),
+                file_name=f"Home_Purchase_Plan_{APP_VERSION}_{datetime.now().strftime('%Y%m%d')}.npz",
+                mime="application/octet-stream", use_container_width=True
+            )
         finally:
-            # 4. 清理暫存的圖檔
+            # 4. 清理暫存的圖檔，並關閉圖表以釋放 matplotlib 佔用的記憶體
             for path in fig_paths.values():
                 if os.path.exists(path):
                     os.remove(path)
+            os.rmdir(fig_dir)
+            for fig in (fig1, fig2, stress_gauge_fig, fig_cost_benefit, fig_pie, fig_lifetime):
+                if fig is not None:
+                    plt.close(fig)
 
 else:
     st.info("👈 請在左方側邊欄設定您的財務參數，然後點擊「執行模擬分析」按鈕。")
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""青年購屋財務規劃模擬器 - 多工作階段負載測試工具
+
+以 Streamlit 內建的 AppTest 框架在本機無頭執行 housing_app.py，
+模擬 N 個同時上線的使用者依序完成：
+設定參數 → 按下「執行模擬分析」→ 採納優化建議 → 取得 PDF 報告，
+並回報吞吐量、各階段 p50/p95/p99 延遲與記憶體峰值。
+全程不需瀏覽器或網路連線。
+
+AppTest 在每次執行時會替換全域的 Runtime 實例，無法在同一行程內以多執行緒並行，
+因此每個工作階段在獨立的子行程中執行。每個子行程在計時前先完成一次不計時的暖機流程，
+排除 Numba 編譯、啟動時的核心比對與冷啟動匯入，使延遲反映穩定狀態。
+
+記憶體峰值回報單一工作階段的最大值，以及各子行程峰值的加總。各子行程不共用快取與全站記憶體管理，
+加總值包含每個直譯器重複的匯入與快取，並非單一伺服器部署時的實際用量。
+
+用法：
+    python loadtest.py --sessions 8 --simulations 1000
+"""
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'housing_app.py')
+STAGES = ('set_params', 'simulate', 'adopt_suggestion', 'pdf')
+
+
+def find_widget(widgets, label):
+    """依標籤尋找元件"""
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"Widget '{label}' not found")
+
+
+def peak_rss_bytes():
+    """目前行程的記憶體峰值 (Linux 以 KB 回報，macOS 以 bytes 回報)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def timed(latencies, stage, action):
+    """執行單一階段並記錄其延遲"""
+    start = time.perf_counter()
+    action()
+    latencies[stage].append(time.perf_counter() - start)
+
+
+def check_no_exception(at, stage):
+    if at.exception:
+        raise RuntimeError(f"{stage}: {at.exception[0].value}")
+
+
+def run_session(session_idx, args, start_barrier):
+    """於子行程中執行單一使用者的完整操作流程，回傳各階段延遲、記憶體峰值與錯誤訊息"""
+    latencies = {stage: [] for stage in STAGES}
+    # 與部署環境一致：於應用程式目錄下執行，以便找到字體檔
+    os.chdir(os.path.dirname(os.path.abspath(args.app)))
+    at = AppTest.from_file(args.app, default_timeout=args.timeout)
+    try:
+        at.run()
+        check_no_exception(at, 'initial_load')
+        # 暖機：先完成一次不計時的完整流程，避免首次模擬的編譯與冷啟動成本混入延遲統計
+        run_flows(at, session_idx, args, {stage: [] for stage in STAGES}, iterations=1)
+    except Exception:
+        start_barrier.abort()
+        return latencies, peak_rss_bytes(), traceback.format_exc(limit=1)
+    try:
+        start_barrier.wait()
+        run_flows(at, session_idx, args, latencies)
+    except Exception:
+        return latencies, peak_rss_bytes(), traceback.format_exc(limit=1)
+    return latencies, peak_rss_bytes(), None
+
+
+def run_flows(at, session_idx, args, latencies, iterations=None):
+    """依序執行各階段操作並記錄延遲"""
+    for _ in range(iterations or args.iterations):
+        # 1. 設定參數：每個工作階段使用略有不同的收入與模擬次數
+        def set_params():
+            find_widget(at.number_input, "每月稅後總收入").set_value(80000 + session_idx * 1000)
+            find_widget(at.select_slider, "模擬次數").set_value(args.simulations)
+            at.run()
+        timed(latencies, 'set_params', set_params)
+        check_no_exception(at, 'set_params')
+
+        # 2. 執行模擬分析
+        def simulate():
+            find_widget(at.button, "🚀 執行模擬分析").click()
+            at.run()
+        timed(latencies, 'simulate', simulate)
+        check_no_exception(at, 'simulate')
+
+        # 3. 採納第一個可用的優化建議 (會立即重新模擬)
+        suggestions = [b for b in at.button if b.key and b.key.startswith('opt')]
+        if suggestions:
+            def adopt():
+                suggestions[0].click()
+                at.run()
+            timed(latencies, 'adopt_suggestion', adopt)
+            check_no_exception(at, 'adopt_suggestion')
+
+        # 4. PDF 報告於每次繪製時產生；重新整理頁面並確認下載按鈕存在
+        def request_pdf():
+            at.run()
+            if not at.get('download_button'):
+                raise RuntimeError("pdf: download button not rendered")
+        timed(latencies, 'pdf', request_pdf)
+        check_no_exception(at, 'pdf')
+
+
+def percentile_row(stage, samples):
+    if not samples:
+        return f"{stage:<18}{'-':>8}{'-':>10}{'-':>10}{'-':>10}{'-':>10}"
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return f"{stage:<18}{len(samples):>8}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{max(samples):>10.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for housing_app.py")
+    parser.add_argument('--sessions', type=int, default=4, help="同時模擬的工作階段數")
+    parser.add_argument('--iterations', type=int, default=1, help="每個工作階段重複完整流程的次數")
+    parser.add_argument('--simulations', type=int, default=1000, choices=[1000, 2000, 5000, 10000], help="每次模擬的路徑數")
+    parser.add_argument('--timeout', type=float, default=600, help="單次 script run 的逾時秒數")
+    parser.add_argument('--app', default=APP_PATH, help="Streamlit 應用程式路徑")
+    args = parser.parse_args()
+
+    ctx = get_context('spawn')
+    with ctx.Manager() as manager, ProcessPoolExecutor(max_workers=args.sessions, mp_context=ctx) as pool:
+        start_barrier = manager.Barrier(args.sessions + 1)
+        futures = [pool.submit(run_session, i, args, start_barrier) for i in range(args.sessions)]
+        try:
+            start_barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        start = time.perf_counter()
+        outcomes = [future.result() for future in futures]
+        wall_time = time.perf_counter() - start
+
+    merged = {stage: [v for latencies, _, _ in outcomes for v in latencies[stage]] for stage in STAGES}
+    errors = [error for _, _, error in outcomes if error]
+    peaks = [peak for _, peak, _ in outcomes]
+    completed = (len(outcomes) - len(errors)) * args.iterations
+    total_ops = sum(len(v) for v in merged.values())
+
+    print(f"\nSessions: {args.sessions}  Iterations: {args.iterations}  Simulations/run: {args.simulations}")
+    print(f"Wall time: {wall_time:.2f} s")
+    print(f"Throughput: {completed / wall_time:.3f} flows/s, {total_ops / wall_time:.3f} stage ops/s")
+    print(f"Peak memory per session: {max(peaks) / 1024 ** 2:,.1f} MB")
+    print(f"Sum of peaks over {len(peaks)} separate processes: {sum(peaks) / 1024 ** 2:,.1f} MB "
+          f"(no shared caches or global budget; not an estimate of single-server memory)\n")
+    print(f"{'stage':<18}{'count':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}")
+    for stage in STAGES:
+        print(percentile_row(stage, merged[stage]))
+
+    if errors:
+        print(f"\n{len(errors)} session(s) failed:")
+        for error in errors:
+            print(f"  - {error.strip().splitlines()[-1]}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()